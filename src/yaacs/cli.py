@@ -3,18 +3,26 @@ from __future__ import annotations
 
 import argparse
 import logging
-import multiprocessing
+import os
 import pathlib
 import re
 import sys
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import lru_cache
 from shutil import which
 from typing import cast, override
 
 from yaacs.consts import VERSION, audio_files
-from yaacs.dispatch import dispatch_conversion
 from yaacs.models import CommandParserArgs, DispatchArgs, GlobalParserArgs
 
 single_process_logger = logging.getLogger("yaacs")
+bitrate_regex = re.compile(r"\d+[kKmM]?")
 
 
 # The command parser is invoked multiple times. This makes that possible
@@ -36,13 +44,13 @@ class GlobalArgsArgparse(argparse.ArgumentParser):
         # if not file:
         #     file = sys.stdout
         if not self.modded_help:
+            base_usage = super().format_usage()
             self.modded_help = (
                 super()
                 .format_help()
                 .replace(
-                    super().format_usage(),
-                    f"{super().format_usage().rstrip()} {
-                        self.command_parser_usage}\n",
+                    base_usage,
+                    f"{base_usage.rstrip()} {self.command_parser_usage}\n",
                 )
                 + self.command_parser_help
                 + "\n"
@@ -81,61 +89,254 @@ class CommandArgsArgparse(argparse.ArgumentParser):
             return super().format_usage()
         return self.modded_usage
 
-
-# Auto-detection recursion
-def get_folders_of_files(media_location: pathlib.Path) -> list[pathlib.Path]:
-    if all(loc.is_file() for loc in media_location.iterdir()):
-        if not list(
-            loc for loc in media_location.iterdir() if loc.suffix[1:] in audio_files
+    def parse_chunk(self, tokens: list[str]) -> CommandParserArgs:
+        # Re-running argparse for every book is slow, so plain spellings of the
+        # flags are scanned here. Anything else (abbreviations, --flag=value,
+        # errors) is handed to argparse so its behaviour and messages are kept.
+        values: dict[str, str | list[str] | bool | None] = {
+            "input": None,
+            "auto": None,
+            "delete": False,
+            "output": None,
+            "metadata": None,
+            "metadatachapter": None,
+            "bitrate": None,
+            "cuesheet": None,
+            "cover": None,
+        }
+        i = 0
+        while i < len(tokens):
+            flag = tokens[i]
+            i += 1
+            if flag in command_switch_flags:
+                values[command_switch_flags[flag]] = True
+            elif flag in command_value_flags:
+                if i == len(tokens) or tokens[i].startswith("-"):
+                    return cast(CommandParserArgs, self.parse_args(tokens))
+                values[command_value_flags[flag]] = tokens[i]
+                i += 1
+            elif flag in command_list_flags:
+                start = i
+                while i < len(tokens) and not tokens[i].startswith("-"):
+                    i += 1
+                if start == i:
+                    return cast(CommandParserArgs, self.parse_args(tokens))
+                values[command_list_flags[flag]] = tokens[start:i]
+            else:
+                return cast(CommandParserArgs, self.parse_args(tokens))
+        if (values["input"] is None) == (values["auto"] is None) or (
+            values["metadata"] is not None and values["metadatachapter"] is not None
         ):
-            return []
-        return [media_location]
-    dirs = (loc for loc in media_location.iterdir() if loc.is_dir())
+            return cast(CommandParserArgs, self.parse_args(tokens))
+        return CommandParserArgs(**values)
+
+
+# Flags understood by CommandArgsArgparse.parse_chunk, keyed to their dest
+command_switch_flags: dict[str, str] = {"-x": "delete", "--delete": "delete"}
+command_list_flags: dict[str, str] = {
+    "-i": "input",
+    "--input": "input",
+    "-a": "auto",
+    "--auto": "auto",
+}
+command_value_flags: dict[str, str] = {
+    "-o": "output",
+    "--output": "output",
+    "-m": "metadata",
+    "--metadata": "metadata",
+    "-M": "metadatachapter",
+    "--metadatachapter": "metadatachapter",
+    "-b": "bitrate",
+    "--bitrate": "bitrate",
+    "-c": "cuesheet",
+    "--cuesheet": "cuesheet",
+    "-I": "cover",
+    "--cover": "cover",
+}
+
+
+@lru_cache(maxsize=1024)
+def resolve_directory(directory: str) -> pathlib.Path:
+    # What Path.resolve() does, without building the intermediate Path first
+    return pathlib.Path(os.path.realpath(directory))
+
+
+def resolve_path(path: str) -> pathlib.Path:
+    # Inputs usually share parents, so resolve each parent directory only once
+    expanded = os.path.expanduser(path)
+    directory, name = os.path.split(expanded)
+    if name in {"", ".", ".."}:
+        return resolve_directory(expanded)
+    resolved = resolve_directory(directory) / name
+    # Like Path.resolve(), follow a symlink in the last component too, so the
+    # default output and -x act on the real file
+    if resolved.is_symlink():
+        return pathlib.Path(os.path.realpath(resolved))
+    return resolved
+
+
+def get_env_int(name: str) -> int:
+    # Unset, malformed or negative values fall back to the automatic choice
+    try:
+        return max(0, int(os.environ.get(name, "")))
+    except ValueError:
+        return 0
+
+
+# Workers do not inherit the parent's -q/-V level under forkserver or spawn
+def set_log_level(level: int) -> None:
+    logging.getLogger().setLevel(level)
+
+
+def report_conversion(result: tuple[str, bool], done: int, total: int) -> None:
+    print_str, success = result
+    if success:
+        single_process_logger.warning(
+            f"Completed conversion and merger into {print_str}: ({done}/{total})"
+        )
+    else:
+        single_process_logger.error(f"Failed to convert {print_str}: ({done}/{total})")
+
+
+# Auto-detection walk
+def scan_directory(directory: str) -> tuple[bool, list[str]]:
+    # Scan each directory once; DirEntry caches the file type from the listing
+    subdirs: list[str] = []
+    only_files = True
+    has_audio = False
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Keep paths canonical, so the walk can tell when a link
+                    # leads back to a directory it has already seen
+                    subdirs.append(
+                        os.path.realpath(entry.path)
+                        if entry.is_symlink()
+                        else entry.path
+                    )
+                    only_files = False
+                elif not entry.is_file():
+                    only_files = False
+                elif not has_audio:
+                    # As in flatten_manual_query and Path.suffix, a name like
+                    # ".mp3" is a hidden file rather than an extension
+                    dot = entry.name.rfind(".")
+                    has_audio = dot > 0 and entry.name[dot + 1 :].lower() in audio_files
+    except OSError:  # Unreadable directories hold no books we can convert
+        return (False, [])
+    return (only_files and has_audio, subdirs)
+
+
+def get_folders_of_files(
+    media_location: pathlib.Path, max_workers: int = 16
+) -> list[pathlib.Path]:
+    # Listing is I/O bound, so overlap scans (matters on network filesystems)
     ans: list[pathlib.Path] = []
-    for dir in dirs:
-        ans.extend(get_folders_of_files(dir))
+    root = os.fspath(media_location)
+    # media_location is already resolved, so every path here is canonical
+    visited = {root}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: dict[Future[tuple[bool, list[str]]], str] = {
+            executor.submit(scan_directory, root): root
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                is_book, subdirs = future.result()
+                if is_book:
+                    ans.append(pathlib.Path(directory))
+                for subdir in subdirs:
+                    if subdir in visited:
+                        continue
+                    visited.add(subdir)
+                    pending[executor.submit(scan_directory, subdir)] = subdir
+    # Scans finish in any order; keep the conversion order deterministic
+    ans.sort()
     return ans
 
 
+def get_input_size(args: DispatchArgs) -> int:
+    # Rough cost of a book for scheduling; folders are only summed one level deep
+    size = 0
+    for location in args.media_locations:
+        try:
+            if not location.is_dir():
+                size += location.stat().st_size
+                continue
+            with os.scandir(location) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        size += entry.stat().st_size
+        except OSError:
+            pass
+    return size
+
+
 def resolve_automatic_conversion(
     media_location: pathlib.Path, bitrate: str | None, delete_originals: bool
 ) -> list[DispatchArgs]:
-    ans: list[DispatchArgs] = []
     single_process_logger.info(f"Detecting books within {media_location.name}")
-    for folder in get_folders_of_files(media_location):
-        output_file = folder.joinpath(f"{folder.stem}.opus").expanduser().resolve()
-        if output_file.exists():
-            x = input(f"File {output_file} exists: Overwrite? (y/N): ")
-            if x not in {"y", "Y"}:
-                sys.exit(1)
-            output_file.unlink()
-        ans.append(
-            DispatchArgs(
-                [folder],
-                None,
-                None,
-                None,
-                True,
-                output_file,
-                bitrate,
-                delete_originals,
-            )
+    return [
+        DispatchArgs(
+            [folder],
+            None,
+            None,
+            None,
+            True,
+            resolve_directory(os.fspath(folder)) / f"{folder.stem}.opus",
+            bitrate,
+            delete_originals,
         )
-    return ans
+        for folder in get_folders_of_files(media_location)
+    ]
+
+
+def skip_existing_outputs(
+    books: list[DispatchArgs], overwrite: bool | None
+) -> set[pathlib.Path]:
+    # Asked once per run, after every -a location has been scanned
+    existing = [book.output_file for book in books if book.output_file.exists()]
+    if not existing:
+        return set()
+    if overwrite is None:
+        listing = "\n".join(str(output_file) for output_file in existing)
+        x = input(
+            f"Files exist:\n{listing}\n"
+            "Overwrite [a]ll, [s]kip these books, or [c]ancel? (a/s/C): "
+        )
+        if x in {"a", "A"}:
+            overwrite = True
+        elif x in {"s", "S"}:
+            overwrite = False
+        else:
+            sys.exit(1)
+    if overwrite:
+        for output_file in existing:
+            output_file.unlink()
+        return set()
+    for output_file in existing:
+        single_process_logger.warning(f"Skipping, {output_file} exists")
+    return set(existing)
 
 
-def validate_inputs(inputs: list[CommandParserArgs]) -> list[DispatchArgs]:
+# overwrite is True for -y, False for --no-clobber and None to ask
+def validate_inputs(
+    inputs: list[CommandParserArgs], overwrite: bool | None
+) -> list[DispatchArgs]:
     ans: list[DispatchArgs] = []
+    auto_books: list[DispatchArgs] = []
     for namespace in inputs:
         if namespace.bitrate:
-            if not re.match(r"\d+[kKmM]?", namespace.bitrate):
+            if not bitrate_regex.fullmatch(namespace.bitrate):
                 single_process_logger.error("Error: Invalid Bitrate")
                 sys.exit(1)
         if namespace.input:
             if namespace.output:
-                output_file = pathlib.Path(namespace.output).expanduser().resolve()
+                output_file = resolve_path(namespace.output)
             else:
-                first_input = pathlib.Path(namespace.input[0]).expanduser().resolve()
+                first_input = resolve_path(namespace.input[0])
                 if first_input.is_dir():
                     output_file = first_input.joinpath(f"{first_input.stem}.opus")
                 else:
@@ -147,27 +348,29 @@ def validate_inputs(inputs: list[CommandParserArgs]) -> list[DispatchArgs]:
                         str(output_file)}"
                 )
             if output_file.exists():
-                x = input(f"File {output_file} exists: Overwrite? (y/N): ")
-                if x not in {"y", "Y"}:
-                    sys.exit(1)
+                if overwrite is False:
+                    single_process_logger.warning(f"Skipping, {output_file} exists")
+                    continue
+                if overwrite is None:
+                    x = input(f"File {output_file} exists: Overwrite? (y/N): ")
+                    if x not in {"y", "Y"}:
+                        sys.exit(1)
             metadata = None
             auto_chapters = True
             if namespace.metadata:
-                metadata = pathlib.Path(namespace.metadata).expanduser().resolve()
+                metadata = resolve_path(namespace.metadata)
             elif namespace.metadatachapter:
-                metadata = (
-                    pathlib.Path(namespace.metadatachapter).expanduser().resolve()
-                )
+                metadata = resolve_path(namespace.metadatachapter)
                 auto_chapters = False
             cuesheet = None
             if namespace.cuesheet:
-                cuesheet = pathlib.Path(namespace.cuesheet).expanduser().resolve()
+                cuesheet = resolve_path(namespace.cuesheet)
             cover_image = None
             if namespace.cover:
-                cover_image = pathlib.Path(namespace.cover).expanduser().resolve()
+                cover_image = resolve_path(namespace.cover)
             ans.append(
                 DispatchArgs(
-                    [pathlib.Path(f).expanduser().resolve() for f in namespace.input],
+                    [resolve_path(f) for f in namespace.input],
                     metadata,
                     cuesheet,
                     cover_image,
@@ -191,17 +394,22 @@ def validate_inputs(inputs: list[CommandParserArgs]) -> list[DispatchArgs]:
                 )
                 sys.exit(1)
             for inner in namespace.auto:
-                ans.extend(
-                    resolve_automatic_conversion(
-                        pathlib.Path(inner).expanduser().resolve(),
-                        namespace.bitrate,
-                        namespace.delete,
-                    )
+                books = resolve_automatic_conversion(
+                    resolve_path(inner), namespace.bitrate, namespace.delete
                 )
+                auto_books.extend(books)
+                ans.extend(books)
+    skipped = skip_existing_outputs(auto_books, overwrite)
+    if skipped:
+        ans = [arg for arg in ans if arg.output_file not in skipped]
     return ans
 
 
 def main() -> None:
+    # Answer a bare --version before looking for ffmpeg or building the parsers
+    if sys.argv[1:] in (["-v"], ["--version"]):
+        print(f"yaacs {VERSION}")
+        return
     if not which("ffmpeg"):
         single_process_logger.error("FFMPEG not found on path. Exiting now.")
         sys.exit(1)
@@ -279,6 +487,19 @@ def main() -> None:
         help="Log more information about the conversion process",
         action="store_true",
     )
+    clobber_opts = parser.add_mutually_exclusive_group()
+    _ = clobber_opts.add_argument(
+        "-y",
+        "--yes",
+        help="Overwrite existing output files without asking",
+        action="store_true",
+    )
+    _ = clobber_opts.add_argument(
+        "-n",
+        "--no-clobber",
+        help="Skip books whose output file already exists instead of asking",
+        action="store_true",
+    )
     _ = parser.add_argument(
         "-t",
         "--threads",
@@ -298,31 +519,57 @@ def main() -> None:
     chunks: list[CommandParserArgs] = []
     start = 0
     for i, curr in enumerate(command_args):
-        if i != 0 and curr in {"-i", "--input", "-a", "--auto"}:
-            chunks.append(
-                cast(
-                    CommandParserArgs, command_parser.parse_args(command_args[start:i])
-                )
-            )
+        if i != 0 and curr in command_list_flags:  # Every book starts with -i/-a
+            chunks.append(command_parser.parse_chunk(command_args[start:i]))
             start = i
-    chunks.append(
-        cast(CommandParserArgs, command_parser.parse_args(command_args[start:]))
-    )
+    chunks.append(command_parser.parse_chunk(command_args[start:]))
     if not chunks:
         single_process_logger.error("Error: No inputs specified")
         sys.exit(1)
-    args = validate_inputs(chunks)
+    overwrite = True if global_args.yes else False if global_args.no_clobber else None
+    args = validate_inputs(chunks, overwrite)
     processes = global_args.threads if global_args.threads != 0 else None
-    with multiprocessing.Pool(processes=processes) as pool:
-        total_amount = len(args)
-        iter = pool.imap_unordered(dispatch_conversion, args)
-        for i, (print_str, success) in enumerate(iter):
-            if success:
-                single_process_logger.warning(
-                    f"Completed conversion and merger into {
-                        print_str}: ({i+1}/{total_amount})"
-                )
-            else:
-                single_process_logger.error(
-                    f"Failed to convert {print_str}: ({i+1}/{total_amount})"
-                )
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, min(processes if processes else cpu_count, len(args)))
+    if len(args) > workers:
+        # Start the longest books first so one doesn't run alone at the end
+        args.sort(key=get_input_size, reverse=True)
+    # Split the cores between concurrent ffmpeg runs instead of oversubscribing,
+    # unless YAACS_FFMPEG_THREADS asks for a fixed count
+    ffmpeg_threads = get_env_int("YAACS_FFMPEG_THREADS") or max(1, cpu_count // workers)
+    # Deferred so that --help, --version and argument errors start quickly
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from yaacs.dispatch import dispatch_conversion, prune_probe_cache
+
+    prune_probe_cache()
+    total_amount = len(args)
+    if total_amount <= 1:
+        # A lone book gains nothing from a worker process, so convert it here
+        for arg in args:
+            report_conversion(dispatch_conversion(arg, ffmpeg_threads), 1, 1)
+        return
+    # Forking a parent holding the parsed arguments is wasteful, and
+    # max_tasks_per_child cannot be used with the fork start method anyway
+    context = None
+    if sys.platform == "linux":
+        context = multiprocessing.get_context("forkserver")
+        # Workers fork from a server that has already built the CUE parser tables
+        context.set_forkserver_preload(["yaacs.dispatch"])
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        max_tasks_per_child=1,
+        initializer=set_log_level,
+        initargs=(logging.getLogger().level,),
+    ) as executor:
+        futures = [
+            executor.submit(dispatch_conversion, arg, ffmpeg_threads) for arg in args
+        ]
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                report_conversion(future.result(), i + 1, total_amount)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
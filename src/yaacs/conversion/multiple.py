@@ -2,40 +2,48 @@ import logging
 import pathlib
 import subprocess
 
+from yaacs.ffmpeg import ffmpeg_args, file_arg, opus_encode_args
 from yaacs.models import Chapter, DiscoveredMetadata, FileInfo
 
+# Quotes inside a concat demuxer path are written as '\''
+concat_escapes = str.maketrans({"'": "'\\''"})
+
 
 def generate_chapters_for_folder(
     file_metadata: list[FileInfo], chapter_file: pathlib.Path, logger: logging.Logger
 ) -> pathlib.Path:
     chapters: list[Chapter] = []
+    add_chapter = chapters.append
     logger.info("Detecting Chapters...")
     for file in file_metadata:
+        title = file.title
         if file.chapters:
+            prepend = title if title else file.filename.stem
             for chapter in file.chapters:
-                prepend = file.title if file.title else file.filename.stem
-                chapters.append(
+                add_chapter(
                     Chapter(f"{prepend} - {chapter.title}", chapter.duration * 1000)
                 )
-        elif file.title:
-            chapters.append(Chapter(file.title, file.duration * 1000))
+        elif title:
+            add_chapter(Chapter(title, file.duration * 1000))
         else:
-            chapters.append(
+            add_chapter(
                 Chapter(
                     file.filename.stem,
                     file.duration * 1000,
                 )
             )
     logger.info(f"Found {len(chapters)} Chapters: {chapters}")
-    with chapter_file.open("w+") as chapterIO:
-        _ = chapterIO.write(";FFMETADATA1\n")
-        duration = 0.0
-        for chapter in chapters:
-            _ = chapterIO.write(
-                f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={duration}\nEND={
-                    duration + chapter.duration}\ntitle={chapter.title}\n"
-            )
-            duration += chapter.duration
+    parts = [";FFMETADATA1\n"]
+    add_part = parts.append
+    duration = 0.0
+    for chapter in chapters:
+        add_part(
+            f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={duration}\nEND={
+                duration + chapter.duration}\ntitle={chapter.title}\n"
+        )
+        duration += chapter.duration
+    with open(chapter_file, "w", encoding="utf-8") as chapterIO:
+        _ = chapterIO.write("".join(parts))
     return chapter_file
 
 
@@ -45,7 +53,7 @@ def generate_metadata_for_folder(
     logger.info("Detecting Metadata...")
     metadata = DiscoveredMetadata("", "", "", "", "", "")
     for file in file_metadata:
-        if not metadata.title and "album" in file.album:
+        if not metadata.title and file.album:
             metadata.title = file.album
         if not metadata.artist and file.artist:
             metadata.artist = file.artist
@@ -57,31 +65,44 @@ def generate_metadata_for_folder(
             metadata.date = file.date
         if not metadata.publisher and file.publisher:
             metadata.publisher = file.publisher
+        # Later files can only fill empty fields, so stop once none are left
+        if (
+            metadata.title
+            and metadata.artist
+            and metadata.performer
+            and metadata.genre
+            and metadata.date
+            and metadata.publisher
+        ):
+            break
     logger.info(f"Found metadata {metadata}")
-    with metadata_file.open("w+") as metadataIO:
-        _ = metadataIO.write(";FFMETADATA1\n")
-        if metadata.title:
-            _ = metadataIO.write(f"title={metadata.title}\n")
-        if metadata.artist:
-            _ = metadataIO.write(f"artist={metadata.artist}\n")
-        if metadata.performer:
-            _ = metadataIO.write(f"performer={metadata.performer}\n")
-        if metadata.genre:
-            _ = metadataIO.write(f"genre={metadata.genre}\n")
-        if metadata.date:
-            _ = metadataIO.write(f"date={metadata.date}\n")
-        if metadata.publisher:
-            _ = metadataIO.write(f"publisher={metadata.publisher}\n")
+    parts = [";FFMETADATA1\n"]
+    if metadata.title:
+        parts.append(f"title={metadata.title}\n")
+    if metadata.artist:
+        parts.append(f"artist={metadata.artist}\n")
+    if metadata.performer:
+        parts.append(f"performer={metadata.performer}\n")
+    if metadata.genre:
+        parts.append(f"genre={metadata.genre}\n")
+    if metadata.date:
+        parts.append(f"date={metadata.date}\n")
+    if metadata.publisher:
+        parts.append(f"publisher={metadata.publisher}\n")
+    with open(metadata_file, "w", encoding="utf-8") as metadataIO:
+        _ = metadataIO.write("".join(parts))
     return metadata_file
 
 
 def merge_together(
     file_metadata: list[FileInfo],
     metadata_file: pathlib.Path | None,
+    cover_metadata_file: pathlib.Path | None,
     auto_chapters: bool,
     output_file: pathlib.Path,
     auto_bitrate: bool,
     bitrate: str,
+    threads: str,
     temp_dir: pathlib.Path,
     logger: logging.Logger,
 ) -> bool:
@@ -91,11 +112,10 @@ def merge_together(
             temp_dir.joinpath(f"{file_metadata[0].filename.stem}.ffmeta"),
             logger,
         )
-    all_same_suffix = True
     first_suffix = file_metadata[0].filename.suffix
-    for file in file_metadata:
-        if file.filename.suffix != first_suffix:
-            all_same_suffix = False
+    all_same_suffix = all(
+        file.filename.suffix == first_suffix for file in file_metadata
+    )
 
     chapter_file = (
         generate_chapters_for_folder(
@@ -108,106 +128,108 @@ def merge_together(
         if auto_chapters
         else None
     )
-    args = ["ffmpeg", "-v", "quiet", "-y"]
+    args: list[str] = [*ffmpeg_args]
+    # Also given to the concat filter path so ffmpeg never reads the terminal
+    concat_list = b""
     if all_same_suffix:
         logger.info("All files have the same suffix. Assuming input concatenation.")
-        concat_filename = temp_dir.joinpath(f"{file_metadata[0].filename.stem}.files")
-        with concat_filename.open("w+") as concat_list:
-            escaped_filenames = (
-                file.filename.absolute().as_posix().replace("'", "'\\''")
-                for file in file_metadata
-            )
-            lines_to_write = (f"file '{filename}'\n" for filename in escaped_filenames)
-            concat_list.writelines(lines_to_write)
+        escaped_filenames = (
+            file.filename.absolute().as_posix().translate(concat_escapes)
+            for file in file_metadata
+        )
+        # The list is piped to ffmpeg's stdin rather than written to temp_dir.
+        # Entries are resolved against the list's URL, so without the file:
+        # prefix ffmpeg would try to open pipe:/path/to/track
+        concat_list = "".join(
+            f"file 'file:{filename}'\n" for filename in escaped_filenames
+        ).encode()
         args.extend(
             [
+                "-threads",
+                threads,
                 "-f",
                 "concat",
                 "-safe",
                 "0",
+                "-protocol_whitelist",
+                "pipe,file",
                 "-i",
-                f"file:{concat_filename}",
+                "pipe:0",
                 "-f",
                 "ffmetadata",
                 "-i",
-                f"file:{metadata_file}",
+                file_arg(metadata_file),
             ]
         )
-        if auto_chapters:
+        if chapter_file:  # Only generated with auto_chapters
+            args.extend(["-f", "ffmetadata", "-i", file_arg(chapter_file)])
+        if cover_metadata_file:
+            # Every input has to come before the first output option
             args.extend(
                 [
                     "-f",
                     "ffmetadata",
                     "-i",
-                    f"file:{chapter_file}",
+                    file_arg(cover_metadata_file),
                     "-map_metadata",
-                    "1",
-                    "-map_chapters",
-                    "2",
+                    "3" if auto_chapters else "2",
                 ]
             )
+        if auto_chapters:
+            args.extend(["-map_metadata", "1", "-map_chapters", "2"])
         else:
             args.extend(["-map_metadata", "1", "-map_chapters", "1"])
+        # The input -threads only caps the decoder; repeat it for the encoder
+        args.extend(["-threads", threads])
         # If auto, preserve bitrate
         if auto_bitrate and first_suffix == ".opus":
             logger.info(
                 "Default bitrate used with opus files. Preserving quality by using copy codec."
             )
-            args.extend(["-c:a", "copy", f"file:{output_file}"])
+            args.extend(["-c:a", "copy", file_arg(output_file)])
         else:
-            args.extend(
-                [
-                    "-c:a",
-                    "libopus",
-                    "-b:a",
-                    bitrate,
-                    "-vbr",
-                    "on",
-                    "-compression_level",
-                    "10",
-                    "-application",
-                    "voip",
-                    f"file:{output_file}",
-                ]
-            )
+            args.extend(opus_encode_args)
+            args.extend(["-b:a", bitrate, file_arg(output_file)])
     else:
         logger.info("Heterogeneous inputs. Using concatenation filter.")
+        args.extend(["-filter_threads", threads])
         for file in file_metadata:
-            args.extend(["-i", f"file:{file.filename}"])
-        args.extend(["-f", "ffmetadata", "-i", f"file:{metadata_file}"])
-        if auto_chapters:
-            args.extend(["-f", "ffmetadata", "-i", f"file:{chapter_file}"])
+            args.extend(["-threads", threads, "-i", file_arg(file.filename)])
+        args.extend(["-f", "ffmetadata", "-i", file_arg(metadata_file)])
+        if chapter_file:  # Only generated with auto_chapters
+            args.extend(["-f", "ffmetadata", "-i", file_arg(chapter_file)])
         # If there are heterogeneous inputs, a filter is the only way to concatenate
+        input_count = len(file_metadata)
+        if cover_metadata_file:
+            args.extend(
+                [
+                    "-f",
+                    "ffmetadata",
+                    "-i",
+                    file_arg(cover_metadata_file),
+                    "-map_metadata",
+                    str(input_count + 2) if auto_chapters else str(input_count + 1),
+                ]
+            )
+        filter_inputs = "".join(f"[{i}:a:0]" for i in range(input_count))
         args.extend(
             [
                 "-filter_complex",
-                f'{"".join(f"[{i}:a:0]" for i, _ in enumerate(file_metadata))}concat={
-                    len(file_metadata)}:v=0:a=1[outa]',
+                f"{filter_inputs}concat={input_count}:v=0:a=1[outa]",
                 "-map",
                 "[outa]",
                 "-map_metadata",
-                str(len(file_metadata)),
+                str(input_count),
                 "-map_chapters",
-                (
-                    str(len(file_metadata) + 1)
-                    if auto_chapters
-                    else str(len(file_metadata))
-                ),
-                "-c:a",
-                "libopus",
-                "-b:a",
-                bitrate,
-                "-vbr",
-                "on",
-                "-compression_level",
-                "10",
-                "-application",
-                "voip",
-                f"file:{output_file}",
+                str(input_count + 1) if auto_chapters else str(input_count),
+                "-threads",
+                threads,
             ]
         )
+        args.extend(opus_encode_args)
+        args.extend(["-b:a", bitrate, file_arg(output_file)])
     # print(args)
-    merger = subprocess.run(args)
+    merger = subprocess.run(args, input=concat_list)
     if merger.returncode != 0:
         logger.error(f"Failed to run: {args}")
     else:
@@ -3,6 +3,7 @@ import pathlib
 import subprocess
 
 from yaacs.cue.parse import VisitError, parse_cue_str, parse_cuefile
+from yaacs.ffmpeg import ffmpeg_args, file_arg, opus_encode_args
 from yaacs.models import FileInfo
 
 
@@ -11,56 +12,53 @@ def final_conversion(
     output_file: pathlib.Path,
     metadata_file: pathlib.Path | None,
     chapter_file: pathlib.Path | None,
+    cover_metadata_file: pathlib.Path | None,
     auto_chapters: bool,
     bitrate: str,
+    threads: str,
     performer: str,
     logger: logging.Logger,
 ) -> bool:
     logger.info(f"Converting single file {init_file.name}")
-    args = ["ffmpeg", "-v", "quiet", "-y", "-i", f"file:{init_file}"]
-    if metadata_file:
+    args = [*ffmpeg_args, "-threads", threads, "-i", file_arg(init_file)]
+    side_file = metadata_file if metadata_file else chapter_file
+    if side_file:
+        args.extend(["-f", "ffmetadata", "-i", file_arg(side_file)])
+    if cover_metadata_file:
+        # Every input has to come before the first output option
         args.extend(
             [
                 "-f",
                 "ffmetadata",
                 "-i",
-                f"file:{metadata_file}",
+                file_arg(cover_metadata_file),
                 "-map_metadata",
-                "1",
+                "2" if side_file else "1",
             ]
         )
+    if metadata_file:
+        args.extend(["-map_metadata", "1"])
         if auto_chapters:
             args.extend(["-map_chapters", "0"])
         else:
             args.extend(["-map_chapters", "1"])
     else:
         if chapter_file:
-            args.extend(["-f", "ffmetadata", "-i", f"file:{chapter_file}"])
             args.extend(["-map_metadata", "0", "-map_chapters", "1"])
         else:
             args.extend(["-map_metadata", "0"])
             args.extend(["-map_chapters", "0"])
         if performer:
             args.extend(["-metadata", f"performer={performer}"])
+    # The input -threads only caps the decoder; repeat it for the encoder
+    args.extend(["-threads", threads])
     if init_file.suffix != ".opus" and bitrate == "-1":
-        args.extend(["-c", "copy", f"file:{output_file}"])
+        args.extend(["-c", "copy", file_arg(output_file)])
     else:
-        args.extend(
-            [
-                "-c:a",
-                "libopus",
-                "-b:a",
-                bitrate,
-                "-vbr",
-                "on",
-                "-compression_level",
-                "10",
-                "-application",
-                "voip",
-                f"file:{output_file}",
-            ]
-        )
-    conversion = subprocess.run(args)
+        args.extend(opus_encode_args)
+        args.extend(["-b:a", bitrate, file_arg(output_file)])
+    # Parallel workers share the terminal; keep ffmpeg from polling it for keys
+    conversion = subprocess.run(args, stdin=subprocess.DEVNULL)
     if conversion.returncode != 0:
         logger.error(f"Failed to run: {args}")
     logger.info(f"Ran: {args}")
@@ -80,18 +78,19 @@ def create_cue_chapter_file(
         if len(cuesheet.files) > 1:
             logger.error("Cuesheet for single input file contains more than one file.")
             return None
-        with chapter_file.open("w") as chapters:
-            _ = chapters.write(";FFMETADATA1\n")
-            for i, track in enumerate(cuesheet.files[0].tracks[:-1]):
-                _ = chapters.write(
-                    f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={track.indices[1] * 1000}\nEND={
-                    cuesheet.files[0].tracks[i + 1].indices[1] * 1000}\ntitle={track.get_title()}\n"
-                )
-            last_track = cuesheet.files[0].tracks[-1]
-            if total_duration > last_track.indices[1]:
-                _ = chapters.write(
-                    f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={last_track.indices[1] * 1000}\nEND={total_duration * 1000}\ntitle={last_track.get_title()}\n"
-                )
+        parts = [";FFMETADATA1\n"]
+        for i, track in enumerate(cuesheet.files[0].tracks[:-1]):
+            parts.append(
+                f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={track.indices[1] * 1000}\nEND={
+                cuesheet.files[0].tracks[i + 1].indices[1] * 1000}\ntitle={track.get_title()}\n"
+            )
+        last_track = cuesheet.files[0].tracks[-1]
+        if total_duration > last_track.indices[1]:
+            parts.append(
+                f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={last_track.indices[1] * 1000}\nEND={total_duration * 1000}\ntitle={last_track.get_title()}\n"
+            )
+        with open(chapter_file, "w", encoding="utf-8") as chapters:
+            _ = chapters.write("".join(parts))
     except (VisitError, ValueError):
         logger.error("Cannot parse cuesheet.")
         return None
@@ -138,8 +137,10 @@ def convert_single_file(
     temp_dir: pathlib.Path,
     output_file: pathlib.Path,
     metadata_file: pathlib.Path | None,
+    cover_metadata_file: pathlib.Path | None,
     auto_chapters: bool,
     bitrate: str,
+    threads: str,
     logger: logging.Logger,
 ) -> bool:
     chapter_file, success = prepare_single_file_conversion(
@@ -152,8 +153,10 @@ def convert_single_file(
         output_file,
         metadata_file,
         chapter_file,
+        cover_metadata_file,
         auto_chapters,
         bitrate,
+        threads,
         metadata.performer,
         logger,
     )
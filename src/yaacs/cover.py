@@ -1,67 +1,144 @@
 import base64
 import logging
+import mmap
+import os
 import pathlib
 import subprocess
 from typing import cast
 
+from mutagen import File as MutagenFile
 from mutagen._util import MutagenError
-from mutagen.flac import Picture
-from mutagen.id3 import PictureType
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import ID3, PictureType
+from mutagen.mp4 import MP4Tags
 from mutagen.oggopus import OggOpus
 
 from .consts import image_files
+from .ffmpeg import ffmpeg_args, file_arg
 from .models import CoverStatus, FileInfo
 
+image_suffix_rank = {suffix: rank for rank, suffix in enumerate(image_files)}
+# Base64 only needs '=' escaped in an ffmetadata value
+ffmetadata_escapes = str.maketrans({"=": "\\="})
+
+
+def encode_picture(cover_image: pathlib.Path, logger: logging.Logger) -> str | None:
+    # Base64 FLAC picture block, the value of a METADATA_BLOCK_PICTURE comment
+    mime = image_files.get(cover_image.suffix[1:])
+    if not mime:
+        logger.error(f"Unsupported cover image type {cover_image.name}")
+        return None
+    picture = Picture()
+    picture.type = cast(int, PictureType.COVER_FRONT)
+    picture.height = 0  # We're allowed to set all these to zero
+    picture.width = 0
+    picture.colors = 0
+    picture.depth = 0
+    picture.desc = "Cover (front)"
+    picture.mime = mime
+    try:
+        # Map the image instead of reading it, and drop each copy as soon as
+        # the next one exists; this keeps parallel workers' peak memory down
+        with (
+            cover_image.open("rb") as img,
+            mmap.mmap(img.fileno(), 0, access=mmap.ACCESS_READ) as image_data,
+        ):
+            picture.data = image_data
+            picture_data = picture.write()
+            picture.data = b""
+    except (IOError, ValueError):
+        logger.error(f"Cannot read cover image {cover_image}")
+        return None
+    vcomment_value = base64.b64encode(picture_data).decode("ascii")
+    del picture_data
+    return vcomment_value
+
+
+def create_cover_metadata_file(
+    cover_image: pathlib.Path, temp_dir: pathlib.Path, logger: logging.Logger
+) -> pathlib.Path | None:
+    # FFMPEG cannot map covers to opus (11/13/24), but it does copy the picture
+    # comment from an ffmetadata input, so the encode can embed it directly
+    vcomment_value = encode_picture(cover_image, logger)
+    if not vcomment_value:
+        return None
+    escaped_value = vcomment_value.translate(ffmetadata_escapes)
+    cover_file = temp_dir.joinpath("cover.ffmeta")
+    with open(cover_file, "w", encoding="utf-8") as coverIO:
+        _ = coverIO.write(f";FFMETADATA1\nMETADATA_BLOCK_PICTURE={escaped_value}\n")
+    return cover_file
+
 
-# FFMPEG cannot map covers to opus (11/13/24)
 def attach_image(
     output_file: pathlib.Path, cover_image: pathlib.Path, logger: logging.Logger
 ) -> bool:
+    logger.info(f"Attaching image for {output_file.name}")
+    vcomment_value = encode_picture(cover_image, logger)
+    if not vcomment_value:
+        return False
     try:
-        logger.info(f"Attaching image for {output_file.name}")
-        with cover_image.open("rb") as img:
-            image_data = img.read()
-        picture = Picture()
-        picture.data = image_data
-        picture.type = cast(int, PictureType.COVER_FRONT)
-        picture.height = 0  # We're allowed to set all these to zero
-        picture.width = 0
-        picture.colors = 0
-        picture.depth = 0
-        picture.desc = "Cover (front)"
-        picture.mime = image_files[cover_image.suffix[1:]]
-        picture_data = picture.write()
-        encoded_data = base64.b64encode(picture_data)
-        vcomment_value = encoded_data.decode("ascii")
-        file = OggOpus(str(output_file))
-        file["metadata_block_picture"] = [vcomment_value]
-        file.save()
+        # Load and save through one handle instead of reopening the output
+        with open(output_file, "r+b") as output:
+            file = OggOpus(output)
+            file["metadata_block_picture"] = [vcomment_value]
+            file.save(output)
         return True
     except (IOError, MutagenError):
         return False
 
 
+def read_embedded_picture(media_file: pathlib.Path) -> bytes | None:
+    # Covers in FLAC, ID3 (mp3/wav/aiff) and MP4 tags are read without ffmpeg
+    try:
+        tagged = MutagenFile(media_file)
+    except (MutagenError, OSError):
+        return None
+    if isinstance(tagged, FLAC):
+        return tagged.pictures[0].data if tagged.pictures else None
+    tags = tagged.tags if tagged else None
+    if isinstance(tags, ID3):
+        frames = tags.getall("APIC")
+        return frames[0].data if frames else None
+    if isinstance(tags, MP4Tags):
+        covers = tags.get("covr")
+        return bytes(covers[0]) if covers else None
+    return None
+
+
 def extract_embedded_image(
-    media_file: pathlib.Path, temp_dir: pathlib.Path, codec: str, logger: logging.Logger
+    media_file: pathlib.Path,
+    temp_dir: pathlib.Path,
+    codec: str,
+    threads: str,
+    logger: logging.Logger,
 ) -> pathlib.Path | None:
     logger.info(f"Extracting image from {media_file.name}")
     if codec[0] == "m":
         codec = codec[1:]
     file_with_image = temp_dir.joinpath(f"{media_file.stem}.{codec}")
+    picture_data = read_embedded_picture(media_file)
+    if picture_data:
+        try:
+            _ = file_with_image.write_bytes(picture_data)
+            logger.info(f"Read embedded image from {media_file.name} tags")
+            return file_with_image
+        except OSError:
+            pass
     extraction_args: list[str] = [
-        "ffmpeg",
-        "-v",
-        "quiet",
-        "-y",
+        *ffmpeg_args,
+        "-threads",
+        threads,
         "-i",
-        f"file:{media_file}",
+        file_arg(media_file),
         "-map",
         "0:v:0",
         "-vcodec",
         "copy",
-        f"file:{file_with_image}",
+        "-threads",
+        threads,
+        file_arg(file_with_image),
     ]
-    extraction = subprocess.run(extraction_args)
+    extraction = subprocess.run(extraction_args, stdin=subprocess.DEVNULL)
     if extraction.returncode != 0:
         logger.error(f"Failed to run {extraction_args}")
         return None
@@ -70,39 +147,60 @@ def extract_embedded_image(
     return file_with_image
 
 
+def find_folder_cover(folder: pathlib.Path) -> pathlib.Path | None:
+    # Single listing; earlier suffixes in image_files still win, like the old globs
+    best_rank = len(image_suffix_rank)
+    best_name = ""
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                name = entry.name
+                dot = name.rfind(".")
+                if dot <= 0:
+                    continue
+                rank = image_suffix_rank.get(name[dot + 1 :], best_rank)
+                if rank < best_rank and entry.is_file():
+                    best_rank = rank
+                    best_name = name
+                    if rank == 0:
+                        break
+    except OSError:
+        return None
+    return folder.joinpath(best_name) if best_name else None
+
+
 def discover_cover_image(
-    file_metadata: list[FileInfo], temp_dir_path: pathlib.Path, logger: logging.Logger
+    file_metadata: list[FileInfo],
+    temp_dir_path: pathlib.Path,
+    threads: str,
+    logger: logging.Logger,
 ) -> pathlib.Path | None:
     logger.info("Discovering cover...")
     for file in file_metadata:
         if file.cover_codec:
             logger.info("Found embedded cover...")
             return extract_embedded_image(
-                file.filename, temp_dir_path, file.cover_codec, logger
+                file.filename, temp_dir_path, file.cover_codec, threads, logger
             )
     logger.info("Searching for cover within folder")
-    for file in file_metadata:
-        images: list[pathlib.Path] = []
-        for suffix in image_files:
-            images.extend(img for img in file.filename.parent.glob(f"*.{suffix}"))
-        if images:
-            logger.info(f"Found cover {images[0].name}")
-            return images[0]
+    # Files of one book usually share a folder, so list each folder once
+    for folder in dict.fromkeys(file.filename.parent for file in file_metadata):
+        image = find_folder_cover(folder)
+        if image:
+            logger.info(f"Found cover {image.name}")
+            return image
     return None
 
 
 def attempt_attach_cover(
-    file_metadata: list[FileInfo],
     output_file: pathlib.Path,
     cover_image: pathlib.Path | None,
-    temp_dir: pathlib.Path,
+    cover_embedded: bool,
     logger: logging.Logger,
 ) -> CoverStatus:
-    if not cover_image:
-        cover_image = discover_cover_image(file_metadata, temp_dir, logger)
     if not cover_image:
         return CoverStatus.NONE_FOUND
-    image_success = attach_image(output_file, cover_image, logger)
-    if image_success:
+    # Only rewrite the output when the encode could not embed the cover
+    if cover_embedded or attach_image(output_file, cover_image, logger):
         return CoverStatus.SUCCESS
     return CoverStatus.ATTACHMENT_FAILED
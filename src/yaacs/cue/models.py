@@ -31,7 +31,7 @@ class TrackFlag(Flag):
     SCMS = auto()
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class Track:
     number: int
     track_type: TrackType
@@ -39,7 +39,7 @@ class Track:
     performer: str | None
     isrc: str | None
     rems: dict[str, list[str]]
-    indices: dict[int, float]
+    indices: list[float]  # Seconds by index number, -1.0 when absent
     pregap: float | None
     postgap: float | None
     flags: TrackFlag = TrackFlag.NONE
@@ -50,7 +50,7 @@ class Track:
         return f"Chapter {self.number}"
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class File:
     filename: str
     file_type: FileType
@@ -60,7 +60,7 @@ class File:
     tracks: list[Track]
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class Cuesheet:
     catalog: str | None
     cdtextfile: str | None
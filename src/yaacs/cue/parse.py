@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import dataclasses
+import re
+from collections.abc import Callable
 from os import PathLike
-from typing import cast
+from typing import ClassVar, cast
 
 from .cue import Interpreter, Lark_StandAlone, Token, Tree, VisitError, v_args
 from .models import Cuesheet, File, FileType, Track, TrackFlag, TrackType
@@ -9,65 +12,61 @@ from .models import Cuesheet, File, FileType, Track, TrackFlag, TrackType
 lark_parser = Lark_StandAlone()
 
 
-def cuetime_to_secs(value: str):
-    comps = value.split(":")
-    return int(comps[0], 10) * 60 + int(comps[1], 10) + int(comps[2], 10) / 75
+def cuetime_to_secs(value: str) -> float:
+    # MM:SS:FF, with 75 frames per second
+    minutes, seconds, frames = value.split(":", 2)
+    return int(minutes) * 60 + int(seconds) + int(frames) / 75
+
+
+flags_by_name: dict[str, TrackFlag] = {
+    "DCP": TrackFlag.DCP,
+    "4CH": TrackFlag.FOURCH,
+    "PRE": TrackFlag.PRE,
+    "SCMS": TrackFlag.SCMS,
+}
+track_types_by_name: dict[str, TrackType] = {
+    "AUDIO": TrackType.AUDIO,
+    "CDG": TrackType.CDG,
+    "MODE1/2048": TrackType.MODE12048,
+    "MODE1/2352": TrackType.MODE12352,
+    "MODE2/2336": TrackType.MODE22336,
+    "MODE2/2352": TrackType.MODE22352,
+    "CDI/2336": TrackType.CDI2336,
+    "CDI/2352": TrackType.CDI2352,
+}
+file_types_by_name: dict[str, FileType] = {
+    "WAVE": FileType.WAVE,
+    "MP3": FileType.MP3,
+    "AIFF": FileType.AIFF,
+    "BINARY": FileType.BINARY,
+    "MOTOROLA": FileType.MOTOROLA,
+}
 
 
 def make_flag(value: str) -> TrackFlag:
-    value = value.upper()
-    if value == "DCP":
-        return TrackFlag.DCP
-    elif value == "4CH":
-        return TrackFlag.FOURCH
-    elif value == "PRE":
-        return TrackFlag.PRE
-    elif value == "SCMS":
-        return TrackFlag.SCMS
-    return TrackFlag.NONE
+    return flags_by_name.get(value.upper(), TrackFlag.NONE)
 
 
 def make_track_type(value: str) -> TrackType:
-    value = value.upper()
-    if value == "AUDIO":
-        return TrackType.AUDIO
-    elif value == "CDG":
-        return TrackType.CDG
-    elif value == "MODE1/2048":
-        return TrackType.MODE12048
-    elif value == "MODE1/2352":
-        return TrackType.MODE12352
-    elif value == "MODE2/2336":
-        return TrackType.MODE22336
-    elif value == "MODE2/2352":
-        return TrackType.MODE22352
-    elif value == "CDI/2336":
-        return TrackType.CDI2336
-    elif value == "CDI/2352":
-        return TrackType.CDI2352
-    raise ValueError("Invalid Track Type")
+    try:
+        return track_types_by_name[value.upper()]
+    except KeyError:
+        raise ValueError("Invalid Track Type") from None
 
 
 def make_file_type(value: str) -> FileType:
-    value = value.upper()
-    if value == "WAVE":
-        return FileType.WAVE
-    elif value == "MP3":
-        return FileType.MP3
-    elif value == "AIFF":
-        return FileType.AIFF
-    elif value == "BINARY":
-        return FileType.BINARY
-    elif value == "MOTOROLA":
-        return FileType.MOTOROLA
-    raise ValueError("Invalid File Type")
+    try:
+        return file_types_by_name[value.upper()]
+    except KeyError:
+        raise ValueError("Invalid File Type") from None
 
 
 def unquote(quote: Token) -> str:
-    return str(quote[1:-1]) if quote.type == "QUOTED_STRING" else str(quote)
+    # Slicing a Token already gives a plain str; only whole Tokens need copying
+    return quote[1:-1] if quote.type == "QUOTED_STRING" else str(quote)
 
 
-class CueInterpreter(Interpreter):
+class CueInterpreter(Interpreter[Token, Cuesheet | File | Track]):
     @v_args(inline=True)
     def track_line(self, number: str, typer: str) -> tuple[int, TrackType]:
         return (int(number, 10), make_track_type(typer))
@@ -117,179 +116,405 @@ class CueInterpreter(Interpreter):
         return cuetime_to_secs(time)
 
     @v_args(tree=True)
-    def track(self, tree: Tree) -> Track:
+    def track(self, tree: Tree[Token]) -> Track:
         track_number, track_type = cast(
-            tuple[int, TrackType], self.track_line(*tree.children[0].children)
+            tuple[int, TrackType],
+            self.track_line(*cast(Tree[Token], tree.children[0]).children),
         )
-        title: str | None = None
-        performer: str | None = None
-        pregap: float | None = None
-        postgap: float | None = None
-        flags: TrackFlag = TrackFlag.NONE
-        isrc: str | None = None
-        rems: dict[str, list[str]] = {}
-        indices: dict[int, float] = {}
-        for child in tree.children[1:]:
-            if child.data == "title_line":
-                if title is not None:
-                    raise VisitError("track", child, "Multiple titles cannot be given")
-                title = cast(str, self.title_line(child.children[0]))
-            elif child.data == "performer_line":
-                if performer is not None:
-                    raise VisitError(
-                        "track", child, "Multiple performers cannot be given"
-                    )
-                performer = cast(str, self.performer_line(child.children[0]))
-            elif child.data == "flag_line":
-                flags = flags | cast(TrackFlag, self.flag_line(child.children[0]))
-            elif child.data == "isrc_line":
-                if isrc is not None:
-                    raise VisitError("track", child, "Multiple isrc cannot be given")
-                isrc = cast(str, self.isrc_line(child.children[0]))
-            elif child.data == "rem_line":
-                k, v = cast(tuple[str, str], self.rem_line(*child.children))
-                if k not in rems:
-                    rems[k] = []
-                rems[k].append(v)
-            elif child.data == "index_line":
-                index, time = cast(tuple[int, float], self.index_line(*child.children))
-                if index in indices:
-                    raise ValueError(
-                        "track",
-                        child,
-                        "Multiple indices with the same index cannot be given",
-                    )
-                indices[index] = time
-            elif child.data == "postgap_line":
-                if postgap is not None:
-                    raise VisitError(
-                        "track", child, "Multiple postgaps cannot be given"
-                    )
-                postgap = cast(float, self.postgap_line(child.children[0]))
-            elif child.data == "pregap_line":
-                if pregap is not None:
-                    raise VisitError("track", child, "Multiple pregaps cannot be given")
-                pregap = cast(float, self.pregap_line(child.children[0]))
-        if 1 not in indices:
+        state = TrackState()
+        for child in cast(list[Tree[Token]], tree.children[1:]):
+            track_handlers[child.data](self, child, state)
+        if len(state.indices) < 2 or state.indices[1] < 0:
             raise VisitError("track", tree, "INDEX 01 ... Line needed for each track.")
         return Track(
             track_number,
             track_type,
-            title,
-            performer,
-            isrc,
-            rems,
-            indices,
-            pregap,
-            postgap,
-            flags,
+            state.title,
+            state.performer,
+            state.isrc,
+            state.rems,
+            state.indices,
+            state.pregap,
+            state.postgap,
+            state.flags,
         )
 
-    def file(self, tree: Tree) -> File:
+    def file(self, tree: Tree[Token]) -> File:
         file_name, file_type = cast(
-            tuple[str, FileType], self.file_line(*tree.children[0].children)
+            tuple[str, FileType],
+            self.file_line(*cast(Tree[Token], tree.children[0]).children),
         )
-        rems: dict[str, list[str]] = {}
-        performer = None
-        title = None
-        tracks: list[Track] = []
-        for child in tree.children[1:]:
-            if child.data == "track":
-                tracks.append(cast(Track, self.track(child)))
-                if len(tracks) > 2 and tracks[-1].number != tracks[-2].number + 1:
-                    raise VisitError("file", child, "Track numbers should be in order")
-            elif child.data == "rem_line":
-                k, v = cast(tuple[str, str], self.rem_line(*child.children))
-                if k not in rems:
-                    rems[k] = []
-                rems[k].append(v)
-            elif child.data == "performer_line":
-                if performer is not None:
-                    raise VisitError(
-                        "file", child, "Multiple performers cannot be given"
-                    )
-                performer = cast(str, self.visit(child.children[0]))
-            elif child.data == "title_line":
-                if title is not None:
-                    raise VisitError("file", child, "Multiple titles cannot be given")
-                title = cast(str, self.title_line(child.children[0]))
-        if not tracks:
+        state = FileState()
+        for child in cast(list[Tree[Token]], tree.children[1:]):
+            file_handlers[child.data](self, child, state)
+        if not state.tracks:
             raise VisitError("file", tree, "All files should contain tracks")
-        return File(file_name, file_type, rems, performer, title, tracks)
-
-    def cuesheet(self, tree: Tree) -> Cuesheet:
-        catalog = None
-        cdtextfile = None
-        rems: dict[str, list[str]] = {}
-        performer = None
-        title = None
-        files: list[File] = []
-        for child in tree.children:
-            if child.data == "catalog_line":
-                if catalog is not None:
-                    raise VisitError(
-                        "cuesheet", child, "Multiple catalogs cannot be given"
-                    )
-                catalog = cast(str, self.catalog_line(child.children[0]))
-            elif child.data == "cdtextfile_line":
-                if cdtextfile is not None:
-                    raise VisitError(
-                        "cuesheet", child, "Mutlitple CD Text Files cannot be given"
-                    )
-                cdtextfile = cast(str, self.cdtextfile_line(child.children[0]))
-            elif child.data == "rem_line":
-                k, v = cast(tuple[str, str], self.rem_line(*child.children))
-                if k not in rems:
-                    rems[k] = []
-                rems[k].append(v)
-            elif child.data == "performer_line":
-                if performer is not None:
-                    raise VisitError(
-                        "cuesheet", child, "Multiple performers cannot be given"
-                    )
-                performer = cast(str, self.performer_line(child.children[0]))
-            elif child.data == "title_line":
-                if title is not None:
-                    raise VisitError(
-                        "cuesheet", child, "Multiple titles cannot be given"
-                    )
-                title = cast(str, self.title_line(child.children[0]))
-            elif child.data == "file":
-                files.append(self.file(child))
-                if (
-                    len(files) > 1
-                    and files[-1].tracks[0].number != files[-2].tracks[-1].number + 1
-                ):
-                    raise VisitError(
-                        "cuesheet", child, "File tracks should be in order"
-                    )
-                elif files[0].tracks[0].number != 1:
-                    raise VisitError(
-                        "cuesheet", child, "First file should contain track 1"
-                    )
-        return Cuesheet(catalog, cdtextfile, rems, performer, title, files)
+        return File(
+            file_name, file_type, state.rems, state.performer, state.title, state.tracks
+        )
+
+    def cuesheet(self, tree: Tree[Token]) -> Cuesheet:
+        state = CuesheetState()
+        for child in cast(list[Tree[Token]], tree.children):
+            cuesheet_handlers[child.data](self, child, state)
+        return Cuesheet(
+            state.catalog,
+            state.cdtextfile,
+            state.rems,
+            state.performer,
+            state.title,
+            state.files,
+        )
 
     @v_args(inline=True)
-    def start(self, value: Tree) -> Cuesheet:
+    def start(self, value: Tree[Token]) -> Cuesheet:
         return self.cuesheet(value)
 
 
+# The interpreter keeps no per-parse state, so one instance is shared
+cue_interpreter = CueInterpreter()
+
+
+# Accumulators for the aggregate rules. Each child line of a rule is routed
+# through a dispatch table to a handler that fills in the rule's state.
+@dataclasses.dataclass
+class TrackState:
+    rule: ClassVar[str] = "track"
+    title: str | None = None
+    performer: str | None = None
+    isrc: str | None = None
+    pregap: float | None = None
+    postgap: float | None = None
+    flags: TrackFlag = TrackFlag.NONE
+    rems: dict[str, list[str]] = dataclasses.field(default_factory=dict)
+    indices: list[float] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class FileState:
+    rule: ClassVar[str] = "file"
+    title: str | None = None
+    performer: str | None = None
+    rems: dict[str, list[str]] = dataclasses.field(default_factory=dict)
+    tracks: list[Track] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class CuesheetState:
+    rule: ClassVar[str] = "cuesheet"
+    title: str | None = None
+    performer: str | None = None
+    catalog: str | None = None
+    cdtextfile: str | None = None
+    rems: dict[str, list[str]] = dataclasses.field(default_factory=dict)
+    files: list[File] = dataclasses.field(default_factory=list)
+
+
+def handle_title(
+    interpreter: CueInterpreter,
+    child: Tree[Token],
+    state: TrackState | FileState | CuesheetState,
+) -> None:
+    if state.title is not None:
+        raise VisitError(state.rule, child, "Multiple titles cannot be given")
+    state.title = cast(str, interpreter.title_line(child.children[0]))
+
+
+def handle_performer(
+    interpreter: CueInterpreter,
+    child: Tree[Token],
+    state: TrackState | FileState | CuesheetState,
+) -> None:
+    if state.performer is not None:
+        raise VisitError(state.rule, child, "Multiple performers cannot be given")
+    state.performer = cast(str, interpreter.performer_line(child.children[0]))
+
+
+def handle_rem(
+    interpreter: CueInterpreter,
+    child: Tree[Token],
+    state: TrackState | FileState | CuesheetState,
+) -> None:
+    k, v = cast(tuple[str, str], interpreter.rem_line(*child.children))
+    state.rems.setdefault(k, []).append(v)
+
+
+def handle_flag(
+    interpreter: CueInterpreter, child: Tree[Token], state: TrackState
+) -> None:
+    state.flags = state.flags | cast(
+        TrackFlag, interpreter.flag_line(child.children[0])
+    )
+
+
+def handle_isrc(
+    interpreter: CueInterpreter, child: Tree[Token], state: TrackState
+) -> None:
+    if state.isrc is not None:
+        raise VisitError("track", child, "Multiple isrc cannot be given")
+    state.isrc = cast(str, interpreter.isrc_line(child.children[0]))
+
+
+def handle_index(
+    interpreter: CueInterpreter, child: Tree[Token], state: TrackState
+) -> None:
+    index, time = cast(tuple[int, float], interpreter.index_line(*child.children))
+    indices = state.indices
+    if index < len(indices) and indices[index] >= 0:
+        raise ValueError(
+            "track",
+            child,
+            "Multiple indices with the same index cannot be given",
+        )
+    if index >= len(indices):
+        indices.extend([-1.0] * (index + 1 - len(indices)))
+    indices[index] = time
+
+
+def handle_postgap(
+    interpreter: CueInterpreter, child: Tree[Token], state: TrackState
+) -> None:
+    if state.postgap is not None:
+        raise VisitError("track", child, "Multiple postgaps cannot be given")
+    state.postgap = cast(float, interpreter.postgap_line(child.children[0]))
+
+
+def handle_pregap(
+    interpreter: CueInterpreter, child: Tree[Token], state: TrackState
+) -> None:
+    if state.pregap is not None:
+        raise VisitError("track", child, "Multiple pregaps cannot be given")
+    state.pregap = cast(float, interpreter.pregap_line(child.children[0]))
+
+
+def handle_track(
+    interpreter: CueInterpreter, child: Tree[Token], state: FileState
+) -> None:
+    tracks = state.tracks
+    tracks.append(cast(Track, interpreter.track(child)))
+    if len(tracks) > 2 and tracks[-1].number != tracks[-2].number + 1:
+        raise VisitError("file", child, "Track numbers should be in order")
+
+
+def handle_catalog(
+    interpreter: CueInterpreter, child: Tree[Token], state: CuesheetState
+) -> None:
+    if state.catalog is not None:
+        raise VisitError("cuesheet", child, "Multiple catalogs cannot be given")
+    state.catalog = cast(str, interpreter.catalog_line(child.children[0]))
+
+
+def handle_cdtextfile(
+    interpreter: CueInterpreter, child: Tree[Token], state: CuesheetState
+) -> None:
+    if state.cdtextfile is not None:
+        raise VisitError("cuesheet", child, "Mutlitple CD Text Files cannot be given")
+    state.cdtextfile = cast(str, interpreter.cdtextfile_line(child.children[0]))
+
+
+def handle_file(
+    interpreter: CueInterpreter, child: Tree[Token], state: CuesheetState
+) -> None:
+    files = state.files
+    files.append(interpreter.file(child))
+    if len(files) > 1 and files[-1].tracks[0].number != files[-2].tracks[-1].number + 1:
+        raise VisitError("cuesheet", child, "File tracks should be in order")
+    elif files[0].tracks[0].number != 1:
+        raise VisitError("cuesheet", child, "First file should contain track 1")
+
+
+track_handlers: dict[str, Callable[[CueInterpreter, Tree[Token], TrackState], None]] = {
+    "title_line": handle_title,
+    "performer_line": handle_performer,
+    "flag_line": handle_flag,
+    "isrc_line": handle_isrc,
+    "rem_line": handle_rem,
+    "index_line": handle_index,
+    "postgap_line": handle_postgap,
+    "pregap_line": handle_pregap,
+}
+file_handlers: dict[str, Callable[[CueInterpreter, Tree[Token], FileState], None]] = {
+    "track": handle_track,
+    "rem_line": handle_rem,
+    "performer_line": handle_performer,
+    "title_line": handle_title,
+}
+cuesheet_handlers: dict[
+    str, Callable[[CueInterpreter, Tree[Token], CuesheetState], None]
+] = {
+    "catalog_line": handle_catalog,
+    "cdtextfile_line": handle_cdtextfile,
+    "rem_line": handle_rem,
+    "performer_line": handle_performer,
+    "title_line": handle_title,
+    "file": handle_file,
+}
+
+
+# Line scanner for well-formed cuesheets. It accepts a strict subset of the
+# grammar and gives up (returns None) on anything else, so Lark still produces
+# the result or the error for unusual sheets.
+line_regex = re.compile(r"[ \t]*(\S+)[ \t]*(.*)")
+quoted_regex = re.compile(r'"([^"\\]*)"[ \t]*')
+rem_regex = re.compile(r'([^\s"]\S*)[ \t]+(.*)')
+file_regex = re.compile(r'(?:"([^"\\]*)"|([^\s"]\S*))[ \t]+(\S+)[ \t]*')
+track_regex = re.compile(r"(0?[1-9]|[1-9][0-9])[ \t]+(\S+)[ \t]*")
+index_regex = re.compile(r"([0-9][0-9]?)[ \t]+([0-9]+:[0-9][0-9]?:[0-9][0-9]?)[ \t]*")
+time_regex = re.compile(r"([0-9]+:[0-9][0-9]?:[0-9][0-9]?)[ \t]*")
+catalog_regex = re.compile(r"([0-9]{13})[ \t]*")
+
+
+def scan_value(rest: str) -> str | None:
+    if rest[:1] == '"':
+        quoted = quoted_regex.fullmatch(rest)
+        return quoted[1] if quoted else None
+    # Unquoted values run to the end of the line, trailing blanks included
+    return rest if rest and not rest[0].isspace() else None
+
+
+def scan_cuesheet(content: str) -> Cuesheet | None:
+    if "\r" in content:
+        return None
+    cuesheet = Cuesheet(None, None, {}, None, None, [])
+    file: File | None = None
+    track: Track | None = None
+    next_number = 1
+    for line in content.split("\n"):
+        line_match = line_regex.fullmatch(line)
+        if not line_match:
+            if line.strip(" \t"):
+                return None
+            continue
+        keyword = line_match[1].upper()
+        rest = line_match[2]
+        current = track if track else file if file else cuesheet
+        if keyword == "TITLE":
+            value = scan_value(rest)
+            if value is None or current.title is not None:
+                return None
+            current.title = value
+        elif keyword == "PERFORMER":
+            value = scan_value(rest)
+            if value is None or current.performer is not None:
+                return None
+            current.performer = value
+        elif keyword == "REM":
+            rem_match = rem_regex.fullmatch(rest)
+            if not rem_match:
+                return None
+            value = scan_value(rem_match[2])
+            if value is None:
+                return None
+            current.rems.setdefault(rem_match[1], []).append(value)
+        elif keyword == "INDEX":
+            index_match = index_regex.fullmatch(rest)
+            if not track or not index_match:
+                return None
+            index = int(index_match[1], 10)
+            indices = track.indices
+            if index < len(indices) and indices[index] >= 0:
+                return None
+            if index >= len(indices):
+                indices.extend([-1.0] * (index + 1 - len(indices)))
+            indices[index] = cuetime_to_secs(index_match[2])
+        elif keyword == "TRACK":
+            track_match = track_regex.fullmatch(rest)
+            if not file or not track_match:
+                return None
+            track_type = track_types_by_name.get(track_match[2].upper())
+            number = int(track_match[1], 10)
+            if track_type is None or number != next_number:
+                return None
+            next_number += 1
+            track = Track(number, track_type, None, None, None, {}, [], None, None)
+            file.tracks.append(track)
+        elif keyword == "FILE":
+            file_match = file_regex.fullmatch(rest)
+            if not file_match:
+                return None
+            file_type = file_types_by_name.get(file_match[3].upper())
+            if file_type is None:
+                return None
+            name = file_match[1] if file_match[1] is not None else file_match[2]
+            file = File(name, file_type, {}, None, None, [])
+            cuesheet.files.append(file)
+            track = None
+        elif keyword == "FLAGS":
+            flag = flags_by_name.get(rest.rstrip(" \t").upper())
+            if not track or flag is None:
+                return None
+            track.flags = track.flags | flag
+        elif keyword == "ISRC":
+            value = scan_value(rest)
+            if not track or value is None or track.isrc is not None:
+                return None
+            track.isrc = value
+        elif keyword == "PREGAP" or keyword == "POSTGAP":
+            time_match = time_regex.fullmatch(rest)
+            if not track or not time_match:
+                return None
+            if keyword == "PREGAP":
+                if track.pregap is not None:
+                    return None
+                track.pregap = cuetime_to_secs(time_match[1])
+            else:
+                if track.postgap is not None:
+                    return None
+                track.postgap = cuetime_to_secs(time_match[1])
+        elif keyword == "CATALOG":
+            catalog_match = catalog_regex.fullmatch(rest)
+            if file or not catalog_match or cuesheet.catalog is not None:
+                return None
+            cuesheet.catalog = catalog_match[1]
+        elif keyword == "CDTEXTFILE":
+            value = scan_value(rest)
+            if file or value is None or cuesheet.cdtextfile is not None:
+                return None
+            cuesheet.cdtextfile = value
+        else:
+            return None
+    for file in cuesheet.files:
+        if not file.tracks:
+            return None
+        for track in file.tracks:
+            if len(track.indices) < 2 or track.indices[1] < 0:
+                return None
+    return cuesheet if cuesheet.files else None
+
+
 def parse_cue_str(content: str) -> Cuesheet:
-    return CueInterpreter().visit(lark_parser.parse(f"{content}\n", start="start"))
+    cuesheet = scan_cuesheet(content)
+    if cuesheet is not None:
+        return cuesheet
+    return cast(
+        Cuesheet,
+        cue_interpreter.visit(lark_parser.parse(f"{content}\n", start="start")),
+    )
 
 
 def parse_file_portion(content: str) -> File:
-    return CueInterpreter().visit(
-        lark_parser.parse(f"{content.lstrip()}\n", start="file")
+    return cast(
+        File,
+        cue_interpreter.visit(lark_parser.parse(f"{content.lstrip()}\n", start="file")),
     )
 
 
 def parse_track(content: str) -> File:
-    return CueInterpreter().visit(
-        lark_parser.parse(f"{content.lstrip()}\n", start="track")
+    return cast(
+        File,
+        cue_interpreter.visit(
+            lark_parser.parse(f"{content.lstrip()}\n", start="track")
+        ),
     )
 
 
-def parse_cuefile(file_name: PathLike) -> Cuesheet:
+def parse_cuefile(file_name: PathLike[str]) -> Cuesheet:
     with open(file_name, "r") as f:
-        return CueInterpreter().visit(lark_parser.parse(f"{f.read()}\n", start="start"))
+        content = f.read()
+    cuesheet = scan_cuesheet(content)
+    if cuesheet is not None:
+        return cuesheet
+    return cast(
+        Cuesheet,
+        cue_interpreter.visit(lark_parser.parse(f"{content}\n", start="start")),
+    )
@@ -1,142 +1,272 @@
-import json
+import hashlib
 import logging
+import os
 import pathlib
+import re
 import subprocess
 import tempfile
-from typing import cast
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from operator import attrgetter
+from typing import TYPE_CHECKING, cast
 
 from yaacs.consts import audio_files
 from yaacs.conversion.multiple import merge_together
 from yaacs.conversion.single import convert_single_file
-from yaacs.cover import attempt_attach_cover
+from yaacs.cover import (
+    attempt_attach_cover,
+    create_cover_metadata_file,
+    discover_cover_image,
+)
+from yaacs.ffmpeg import file_arg
 from yaacs.models import Chapter, CoverStatus, DispatchArgs, FFProbeResult, FileInfo
 
+if TYPE_CHECKING:  # orjson may be missing, so check against the stdlib signature
+    from json import loads as json_loads
+else:
+    try:  # Optional, see the "fast" extra; both parse ffprobe's bytes directly
+        from orjson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
 
-def empty_not_none(s: str | None) -> str:
-    if not s:
-        return ""
-    return s
+# Entries unused for this long are removed by prune_probe_cache()
+probe_cache_max_age = 30 * 24 * 60 * 60
+
+# Free space /dev/shm needs before scratch files are put there
+shm_min_free = 64 * 1024 * 1024
+
+ffprobe_args: tuple[str, ...] = (
+    "ffprobe",
+    "-v",
+    "quiet",
+    "-of",
+    "json",
+    "-show_entries",
+    "stream:format",
+    "-show_chapters",
+)
+
+# Track and disc tags look like "3" or "3/12"
+leading_digits_regex = re.compile(r"[0-9]+")
+# Tags that may hold the narrator, most specific first
+performer_tags = ("performer", "narratedby", "composer", "album_artist")
 
 
 def get_initial_int(x: str | None) -> int | None:  # atoi() in Python
-    if x is None:
-        return None
-    try:
-        return int(x.replace(x.lstrip("0123456789"), ""))
-    except (ValueError, AttributeError):
+    if not x:
         return None
+    digits = leading_digits_regex.match(x)
+    return int(digits[0]) if digits else None
 
 
 def get_performer(
     raw_metadata: FFProbeResult,
 ) -> str:  # Most formats don't have a performer tag
-    if raw_metadata["format"]["tags"].get("performer"):
-        return cast(str, raw_metadata["format"]["tags"].get("performer"))
-    if raw_metadata["format"]["tags"].get("narratedby"):
-        return cast(str, raw_metadata["format"]["tags"].get("narratedby"))
-    if raw_metadata["format"]["tags"].get("composer"):
-        return cast(str, raw_metadata["format"]["tags"].get("composer"))
-    if raw_metadata["format"]["tags"].get("album_artist"):
-        return cast(str, raw_metadata["format"]["tags"].get("album_artist"))
+    tags = raw_metadata["format"]["tags"]
+    for key in performer_tags:
+        performer = tags.get(key)
+        if performer:
+            return cast(str, performer)
     return ""
 
 
-def get_metadata(music_file: pathlib.Path, logger: logging.Logger) -> FileInfo:
-    logger.info(f"Getting metadata... for {music_file.name}")
-    metadata_args = [
-        "ffprobe",
-        "-v",
-        "quiet",
-        "-of",
-        "json",
-        "-show_entries",
-        "stream:format",
-        "-show_chapters",
-        f"file:{music_file}",
-    ]
+def get_temp_root() -> str:
+    explicit_root = os.environ.get("YAACS_TMPDIR")
+    if explicit_root:
+        return explicit_root
+    # Scratch files (ffmetadata, extracted covers) are rewritten often, so
+    # prefer memory-backed storage, unless TMPDIR asks for somewhere else
+    if not os.environ.get("TMPDIR") and os.access("/dev/shm", os.W_OK | os.X_OK):
+        try:
+            shm = os.statvfs("/dev/shm")
+            if shm.f_bavail * shm.f_frsize >= shm_min_free:
+                return "/dev/shm"
+        except (AttributeError, OSError):  # No statvfs on Windows
+            pass
+    return tempfile.gettempdir()
+
+
+def get_probe_cache_dir() -> pathlib.Path | None:
+    # Looked up on use rather than import, so YAACS_NO_PROBE_CACHE and
+    # XDG_CACHE_HOME are honoured and a missing home directory is harmless
+    if os.environ.get("YAACS_NO_PROBE_CACHE"):
+        return None
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+    try:
+        cache_home = (
+            pathlib.Path(xdg_cache_home)
+            if xdg_cache_home
+            else pathlib.Path.home().joinpath(".cache")
+        )
+    except RuntimeError:
+        return None
+    # Per user, so another account cannot plant entries
+    return cache_home.joinpath("yaacs", "ffprobe")
+
+
+def prune_probe_cache() -> None:
+    cache_dir = get_probe_cache_dir()
+    if not cache_dir:
+        return
+    cutoff = time.time() - probe_cache_max_age
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return
+    # Also sweeps up partial entries left behind by interrupted runs
+    for entry in entries:
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def get_probe_cache_entry(music_file: pathlib.Path) -> pathlib.Path | None:
+    cache_dir = get_probe_cache_dir()
+    if not cache_dir:
+        return None
+    # Keyed on path, size and mtime so edited or replaced files are probed again
+    try:
+        stat = music_file.stat()
+    except OSError:
+        return None
+    key = f"{music_file}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    digest = hashlib.sha256(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return cache_dir.joinpath(f"{digest}.json")
+
+
+def run_ffprobe(music_file: pathlib.Path, logger: logging.Logger) -> bytes:
+    cache_entry = get_probe_cache_entry(music_file)
+    if cache_entry:
+        try:
+            probe_output = cache_entry.read_bytes()
+            # Pruning goes by mtime, so mark the entry as recently used
+            os.utime(cache_entry)
+            logger.info(f"Using cached metadata for {music_file.name}")
+            return probe_output
+        except OSError:
+            pass
+    metadata_args = [*ffprobe_args, file_arg(music_file)]
     logger.info(f"Running {metadata_args}")
-    json_string = subprocess.run(
+    # -v quiet leaves nothing worth reading on stderr; fail loudly instead of
+    # handing an empty document to the JSON parser
+    probe = subprocess.run(
         metadata_args,
-        capture_output=True,
-    ).stdout.decode("utf-8")
-    metadata = json.loads(json_string)
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    if cache_entry:
+        try:
+            cache_entry.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename, so concurrent workers never read a partial entry
+            with tempfile.NamedTemporaryFile(
+                dir=cache_entry.parent, suffix=".tmp", delete=False
+            ) as partial:
+                _ = partial.write(probe.stdout)
+            os.replace(partial.name, cache_entry)
+        except OSError:
+            logger.info(f"Could not cache metadata for {music_file.name}")
+    return probe.stdout
+
+
+def get_metadata(music_file: pathlib.Path, logger: logging.Logger) -> FileInfo:
+    logger.info(f"Getting metadata... for {music_file.name}")
+    metadata = json_loads(run_ffprobe(music_file, logger))
     if "tags" not in metadata["format"]:
         metadata["format"]["tags"] = {}
     if music_file.suffix == ".opus":  # FFMpeg maps opus tags wrong (11/13/24)
-        for k, v in metadata["streams"][0]["tags"]:
-            metadata["format"]["tags"][k] = v
+        metadata["format"]["tags"].update(metadata["streams"][0].get("tags", {}))
     metadata = cast(FFProbeResult, metadata)
+    tags = metadata["format"]["tags"]
     ans = FileInfo(
         filename=music_file,
         performer=get_performer(metadata),
         cuesheet="",
         chapters=[],
         bit_rate=int(metadata["format"]["bit_rate"]),
-        title=empty_not_none(metadata["format"]["tags"].get("title")),
-        album=empty_not_none(metadata["format"]["tags"].get("album")),
-        genre=empty_not_none(metadata["format"]["tags"].get("genre")),
-        date=empty_not_none(metadata["format"]["tags"].get("date")),
-        publisher=empty_not_none(metadata["format"]["tags"].get("publisher")),
-        track=get_initial_int(metadata["format"]["tags"].get("track")),
-        disc=get_initial_int(metadata["format"]["tags"].get("disc")),
+        title=tags.get("title") or "",
+        album=tags.get("album") or "",
+        genre=tags.get("genre") or "",
+        date=tags.get("date") or "",
+        publisher=tags.get("publisher") or "",
+        track=get_initial_int(tags.get("track")),
+        disc=get_initial_int(tags.get("disc")),
         duration=float(metadata["format"]["duration"]),
-        artist=empty_not_none(metadata["format"]["tags"].get("artist")),
+        artist=tags.get("artist") or "",
         cover_codec="",
     )
-    if any(stream["codec_type"] == "video" for stream in metadata["streams"]):
-        ans.cover_codec = next(
-            stream["codec_name"]
-            for stream in metadata["streams"]
-            if stream["codec_type"] == "video"
-        )
-    if metadata["format"]["tags"].get("CUESHEET"):
-        ans.cuesheet = cast(str, metadata["format"]["tags"]["CUESHEET"])
-    elif metadata["format"]["tags"].get("cuesheet"):
-        ans.cuesheet = cast(str, metadata["format"]["tags"].get("cuesheet"))
+    for stream in metadata["streams"]:
+        if stream["codec_type"] == "video":
+            ans.cover_codec = stream["codec_name"]
+            break
+    if tags.get("CUESHEET"):
+        ans.cuesheet = cast(str, tags["CUESHEET"])
+    elif tags.get("cuesheet"):
+        ans.cuesheet = cast(str, tags.get("cuesheet"))
     if ans.cuesheet and "FILE" not in ans.cuesheet:
         ans.cuesheet = f'FILE "{music_file.name}" MP3\n{ans.cuesheet}\n'
-    if metadata["chapters"]:
-        for i, chapter in enumerate(metadata["chapters"]):
-            next_start = (
-                metadata["chapters"][i + 1]["start_time"]
-                if i + 1 < len(metadata["chapters"])
-                else metadata["format"]["duration"]
-            )
-            ans.chapters.append(
-                Chapter(
-                    (
-                        cast(str, chapter["tags"]["title"])
-                        if chapter["tags"].get("title")
-                        else f"Chapter {int(chapter['id']) + 1}"
-                    ),
-                    (float(next_start) - float(chapter["start_time"])),
-                )
+    chapters = metadata["chapters"]
+    if chapters:
+        # Each chapter runs until the next one starts, the last one to the end
+        chapter_ends = [chapter["start_time"] for chapter in chapters[1:]]
+        chapter_ends.append(metadata["format"]["duration"])
+        ans.chapters = [
+            Chapter(
+                chapter.get("tags", {}).get("title")
+                or f"Chapter {int(chapter['id']) + 1}",
+                float(end) - float(chapter["start_time"]),
             )
+            for chapter, end in zip(chapters, chapter_ends)
+        ]
     return ans
 
 
 def flatten_manual_query(media_locations: list[pathlib.Path]) -> list[pathlib.Path]:
-    delete_idxs = [1]
-    while len(delete_idxs) > 0:
-        delete_idxs.clear()
-        size = len(media_locations)
-        for i in range(size):
-            if media_locations[i].is_dir():
-                delete_idxs.append(i)
-                for suffix in audio_files:
-                    media_locations.extend(media_locations[i].glob(f"*.{suffix}"))
-                media_locations.extend(
-                    loc for loc in media_locations[i].iterdir() if loc.is_dir()
-                )
-        for idx in reversed(delete_idxs):
-            del media_locations[idx]
-    return media_locations
+    # Given files are kept as is; folders are replaced by the audio files below
+    # them, listing each folder once
+    flattened: list[pathlib.Path] = []
+    pending = deque(media_locations)
+    # Inputs are already resolved, and links are followed to their real path,
+    # so a link back to a walked directory is recognised and skipped
+    visited = {os.fspath(location) for location in media_locations}
+    while pending:
+        location = pending.popleft()
+        if not location.is_dir():
+            flattened.append(location)
+            continue
+        # DirEntry answers is_dir from the listing, without a stat per child
+        with os.scandir(location) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdir = (
+                        os.path.realpath(entry.path)
+                        if entry.is_symlink()
+                        else entry.path
+                    )
+                    if subdir not in visited:
+                        visited.add(subdir)
+                        pending.append(pathlib.Path(subdir))
+                    continue
+                dot = entry.name.rfind(".")
+                if dot > 0 and entry.name[dot + 1 :].lower() in audio_files:
+                    flattened.append(pathlib.Path(entry.path))
+    return flattened
 
 
 def prepare_file_metadata(
     media_locations: list[pathlib.Path], logger: logging.Logger
 ) -> list[FileInfo]:
-    file_metadata = [get_metadata(file, logger) for file in media_locations]
+    # Each probe is a blocking ffprobe process, so overlap them with threads
+    workers = min(len(media_locations), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        file_metadata = list(
+            executor.map(get_metadata, media_locations, repeat(logger))
+        )
     if all(meta.track for meta in file_metadata):
         logger.info(f"Sorting {[loc.name for loc in media_locations]} by track number")
         file_metadata.sort(
@@ -144,12 +274,12 @@ def prepare_file_metadata(
         )
     else:
         logger.info(f"Sorting {[loc.name for loc in media_locations]} by file name")
-        file_metadata.sort(key=lambda x: x.filename.stem)
+        file_metadata.sort(key=attrgetter("filename.stem"))
     return file_metadata
 
 
-def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
-    media_locations = flatten_manual_query(args.media_locations.copy())
+def dispatch_conversion(args: DispatchArgs, threads: int = 0) -> tuple[str, bool]:
+    media_locations = flatten_manual_query(args.media_locations)
     metadata_file = args.metadata_file
     cuesheet = args.cuesheet
     cover_image = args.cover_image
@@ -157,11 +287,14 @@ def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
     output_file = args.output_file
     bitrate = args.bitrate
     delete_originals = args.delete_originals
+    ffmpeg_threads = str(threads)
     logger = logging.getLogger("yaacs subprocess")
+    # Reported on every failure path, so build it once
+    media_names = ", ".join([loc.name for loc in args.media_locations])
     logger.warning(f"Converting {','.join(str(loc) for loc in args.media_locations)}")
     try:
         file_metadata = prepare_file_metadata(media_locations, logger)
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=get_temp_root()) as temp_dir:
             temp_dir_path = pathlib.Path(temp_dir).expanduser().resolve()
             auto_bitrate = False
             if not bitrate:
@@ -174,26 +307,31 @@ def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
                 else:
                     logger.info("Auto bitrate set to 32k")
                     bitrate = "32k"
+            if not cover_image:
+                cover_image = discover_cover_image(
+                    file_metadata, temp_dir_path, ffmpeg_threads, logger
+                )
+            cover_metadata_file = (
+                create_cover_metadata_file(cover_image, temp_dir_path, logger)
+                if cover_image
+                else None
+            )
             success = False
             if len(media_locations) > 1:
                 if cuesheet:
                     logger.error(
                         "Error! Cannot have a singular cuesheet with multiple files"
                     )
-                    return (
-                        ",".join(
-                            media_location.name
-                            for media_location in args.media_locations
-                        ),
-                        False,
-                    )
+                    return media_names, False
                 success = merge_together(
                     file_metadata,
                     metadata_file,
+                    cover_metadata_file,
                     auto_chapters,
                     output_file,
                     auto_bitrate,
                     bitrate,
+                    ffmpeg_threads,
                     temp_dir_path,
                     logger,
                 )
@@ -202,13 +340,7 @@ def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
                     logger.warning(
                         f"{file_metadata[0].filename.name} is already a .opus file. An explicit bitrate is required for downsampling."
                     )
-                    return (
-                        ", ".join(
-                            media_location.name
-                            for media_location in args.media_locations
-                        ),
-                        False,
-                    )
+                    return media_names, False
                 bitrate = bitrate.replace("|", "")
                 success = convert_single_file(
                     file_metadata[0],
@@ -216,23 +348,22 @@ def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
                     temp_dir_path,
                     output_file,
                     metadata_file,
+                    cover_metadata_file,
                     auto_chapters,
                     bitrate,
+                    ffmpeg_threads,
                     logger,
                 )
             if success:
                 image_status = attempt_attach_cover(
-                    file_metadata, output_file, cover_image, temp_dir_path, logger
+                    output_file, cover_image, cover_metadata_file is not None, logger
                 )
                 if image_status == CoverStatus.ATTACHMENT_FAILED:
                     logger.error(f"Failed to attach cover image to {output_file}")
                 elif image_status == CoverStatus.SUCCESS:
                     logger.info(f"Attached cover image to {output_file}")
                 else:
-                    logger.warning(
-                        f"Cover image not found for {
-                            ', '.join(loc.name for loc in args.media_locations)}"
-                    )
+                    logger.warning(f"Cover image not found for {media_names}")
         if success and delete_originals:
             logger.info("Deleting input files")
             for loc in media_locations:
@@ -241,19 +372,8 @@ def dispatch_conversion(args: DispatchArgs) -> tuple[str, bool]:
             if output_file.exists():
                 logger.info("Deleting failed output")
                 output_file.unlink()
-            return (
-                ", ".join(
-                    media_location.name for media_location in args.media_locations
-                ),
-                False,
-            )
+            return media_names, False
         return output_file.name, True
     except Exception as e:
-        logger.exception(
-            f"Exception when converting {', '.join(
-                media_location.name for media_location in args.media_locations)}: {repr(e)}"
-        )
-        return (
-            ", ".join(media_location.name for media_location in args.media_locations),
-            False,
-        )
+        logger.exception(f"Exception when converting {media_names}: {repr(e)}")
+        return media_names, False
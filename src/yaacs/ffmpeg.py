@@ -0,0 +1,23 @@
+import os
+import pathlib
+
+
+# Paths are passed with the file: protocol so names like "a:b.mp3" aren't parsed
+def file_arg(path: pathlib.Path) -> str:
+    return "file:" + os.fspath(path)
+
+
+# Every ffmpeg run is silent and may overwrite its (temporary or confirmed) output
+ffmpeg_args: tuple[str, ...] = ("ffmpeg", "-v", "quiet", "-y")
+
+# libopus settings shared by every encode; the bitrate is given per call
+opus_encode_args: tuple[str, ...] = (
+    "-c:a",
+    "libopus",
+    "-vbr",
+    "on",
+    "-compression_level",
+    "10",
+    "-application",
+    "voip",
+)
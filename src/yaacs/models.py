@@ -6,13 +6,13 @@ from enum import Enum, auto
 from typing import TypedDict
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Chapter:
     title: str
     duration: float
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class DiscoveredMetadata:
     title: str
     artist: str
@@ -22,7 +22,7 @@ class DiscoveredMetadata:
     date: str
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class FileInfo:
     filename: pathlib.Path
     performer: str
@@ -41,7 +41,7 @@ class FileInfo:
     cover_codec: str
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class DispatchArgs:
     media_locations: list[pathlib.Path]
     metadata_file: pathlib.Path | None
@@ -120,3 +120,5 @@ class GlobalParserArgs(argparse.Namespace):
     quiet: bool  # pyright: ignore[reportUninitializedInstanceVariable]
     verbose: bool  # pyright: ignore[reportUninitializedInstanceVariable]
     threads: int  # pyright: ignore[reportUninitializedInstanceVariable]
+    yes: bool  # pyright: ignore[reportUninitializedInstanceVariable]
+    no_clobber: bool  # pyright: ignore[reportUninitializedInstanceVariable]
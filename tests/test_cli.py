@@ -0,0 +1,132 @@
+import os
+import pathlib
+
+import pytest
+
+from yaacs.cli import (
+    get_folders_of_files,
+    resolve_directory,
+    resolve_path,
+    scan_directory,
+    validate_inputs,
+)
+from yaacs.models import CommandParserArgs
+
+
+@pytest.fixture
+def library(tmp_path: pathlib.Path) -> pathlib.Path:
+    # Relative directories are cached by name, and each test has its own cwd
+    resolve_directory.cache_clear()
+    tmp_path.joinpath("real").mkdir()
+    tmp_path.joinpath("real", "book.mp3").write_bytes(b"")
+    tmp_path.joinpath("links").mkdir()
+    tmp_path.joinpath("links", "book.mp3").symlink_to("../real/book.mp3")
+    tmp_path.joinpath("dirlink").symlink_to("real")
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "links/book.mp3",
+        "real/book.mp3",
+        "dirlink",
+        "dirlink/",
+        "dirlink/book.mp3",
+        "links/../real/book.mp3",
+        "real/missing.mp3",
+        ".",
+    ],
+)
+def test_resolve_path_matches_path_resolve(
+    library: pathlib.Path, monkeypatch: pytest.MonkeyPatch, path: str
+):
+    monkeypatch.chdir(library)
+    assert resolve_path(path) == pathlib.Path(path).resolve()
+
+
+def test_symlinked_input_resolves_to_target(library: pathlib.Path):
+    link = os.fspath(library.joinpath("links", "book.mp3"))
+    assert resolve_path(link) == library.joinpath("real", "book.mp3").resolve()
+
+
+def test_symlinked_input_default_output(library: pathlib.Path):
+    namespace = CommandParserArgs(
+        input=[os.fspath(library.joinpath("links", "book.mp3"))],
+        auto=None,
+        delete=True,
+        output=None,
+        metadata=None,
+        metadatachapter=None,
+        bitrate=None,
+        cuesheet=None,
+        cover=None,
+    )
+    (args,) = validate_inputs([namespace], None)
+    real = library.joinpath("real").resolve()
+    # -x must delete the original, not the link, and output goes beside it
+    assert args.media_locations == [real.joinpath("book.mp3")]
+    assert args.output_file == real.joinpath("book.opus")
+
+
+def test_auto_detection_survives_link_cycle(library: pathlib.Path):
+    library.joinpath("real", "loop").symlink_to("..")
+    library.joinpath("real", "self").symlink_to("self")
+    library.joinpath("book").mkdir()
+    library.joinpath("book", "01.mp3").write_bytes(b"")
+    root = resolve_path(os.fspath(library))
+    # dirlink and loop lead back to directories already walked
+    assert get_folders_of_files(root) == [root.joinpath("book"), root.joinpath("links")]
+
+
+@pytest.mark.parametrize(
+    ("name", "is_book"), [("book.mp3", True), ("book.MP3", True), (".mp3", False)]
+)
+def test_scan_directory_extension_rule(
+    tmp_path: pathlib.Path, name: str, is_book: bool
+):
+    tmp_path.joinpath(name).write_bytes(b"")
+    assert scan_directory(os.fspath(tmp_path)) == (is_book, [])
+
+
+def test_auto_overwrite_prompt_once_per_run(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+):
+    resolve_directory.cache_clear()
+    for shelf in ("one", "two"):
+        for book in ("old", "new"):
+            tmp_path.joinpath(shelf, book).mkdir(parents=True)
+            tmp_path.joinpath(shelf, book, "01.mp3").write_bytes(b"")
+        tmp_path.joinpath(shelf, "old", "old.opus").write_bytes(b"")
+    prompts: list[str] = []
+
+    def answer(prompt: str) -> str:
+        prompts.append(prompt)
+        return "s"
+
+    monkeypatch.setattr("builtins.input", answer)
+    namespace = CommandParserArgs(
+        input=None,
+        auto=[os.fspath(tmp_path.joinpath("one")), os.fspath(tmp_path.joinpath("two"))],
+        delete=False,
+        output=None,
+        metadata=None,
+        metadatachapter=None,
+        bitrate=None,
+        cuesheet=None,
+        cover=None,
+    )
+    args = validate_inputs([namespace], None)
+    root = tmp_path.resolve()
+    assert len(prompts) == 1
+    assert [arg.media_locations for arg in args] == [
+        [root.joinpath("one", "new")],
+        [root.joinpath("two", "new")],
+    ]
+    skipped = [record.getMessage() for record in caplog.records]
+    assert skipped == [
+        f"Skipping, {root.joinpath(shelf, 'old', 'old.opus')} exists"
+        for shelf in ("one", "two")
+    ]
@@ -0,0 +1,95 @@
+import logging
+import pathlib
+import shutil
+import subprocess
+
+import pytest
+
+from yaacs.conversion.multiple import merge_together
+from yaacs.models import FileInfo
+
+pytestmark = pytest.mark.skipif(not shutil.which("ffmpeg"), reason="needs ffmpeg")
+logger = logging.getLogger("yaacs test")
+
+
+def make_track(path: pathlib.Path, codec: str) -> FileInfo:
+    _ = subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "sine=d=1"]
+        + ["-c:a", codec, f"file:{path}"],
+        check=True,
+    )
+    return FileInfo(
+        filename=path,
+        performer="",
+        cuesheet="",
+        chapters=[],
+        bit_rate=64000,
+        title="",
+        album="Book",
+        genre="",
+        date="",
+        publisher="",
+        track=None,
+        disc=None,
+        duration=1.0,
+        artist="",
+        cover_codec="",
+    )
+
+
+def read_chapter_count(output: pathlib.Path) -> int:
+    metadata = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", f"file:{output}", "-f", "ffmetadata", "-"],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return metadata.stdout.count(b"[CHAPTER]")
+
+
+@pytest.mark.parametrize(
+    ("auto_bitrate", "codec", "suffix"),
+    [(True, "libopus", ".opus"), (False, "libopus", ".opus"), (False, "flac", ".flac")],
+)
+def test_homogeneous_concat(
+    tmp_path: pathlib.Path, auto_bitrate: bool, codec: str, suffix: str
+):
+    # Quotes and colons must survive the concat list escaping
+    tracks = [
+        make_track(tmp_path.joinpath(f"{name}{suffix}"), codec)
+        for name in ("01 it's", "02 a:b")
+    ]
+    output = tmp_path.joinpath("book.opus")
+    assert merge_together(
+        tracks, None, None, True, output, auto_bitrate, "32k", "1", tmp_path, logger
+    )
+    assert read_chapter_count(output) == 2
+
+
+def test_heterogeneous_concat(tmp_path: pathlib.Path):
+    tracks = [
+        make_track(tmp_path.joinpath("01.opus"), "libopus"),
+        make_track(tmp_path.joinpath("02.flac"), "flac"),
+    ]
+    output = tmp_path.joinpath("book.opus")
+    assert merge_together(
+        tracks, None, None, True, output, False, "32k", "1", tmp_path, logger
+    )
+    assert read_chapter_count(output) == 2
+
+
+@pytest.mark.parametrize("suffixes", [(".opus", ".opus"), (".opus", ".flac")])
+def test_concat_without_auto_chapters(
+    tmp_path: pathlib.Path, suffixes: tuple[str, str]
+):
+    tracks = [
+        make_track(
+            tmp_path.joinpath(f"{i:02}{suffix}"),
+            "libopus" if suffix == ".opus" else "flac",
+        )
+        for i, suffix in enumerate(suffixes)
+    ]
+    output = tmp_path.joinpath("book.opus")
+    assert merge_together(
+        tracks, None, None, False, output, False, "32k", "1", tmp_path, logger
+    )
+    assert read_chapter_count(output) == 0